@@ -1,4 +1,6 @@
 #stdlib
+import os
+import hashlib
 from decimal import Decimal
 from datetime import datetime
 from typing import List, Optional, Union
@@ -6,15 +8,20 @@ from contextlib import asynccontextmanager
 
 #3rd party
 from pydantic import BaseModel
-from sqlmodel import  SQLModel, Session, select, create_engine
+from sqlmodel import  SQLModel, select
 from sqlmodel import Field, Relationship
 
-from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import RedirectResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import RedirectResponse, StreamingResponse
+
+from async_lru import alru_cache
 
 from faker import Faker
 
-from sqlalchemy.orm import selectinload
+from sqlalchemy import insert, update
+from sqlalchemy.orm import raiseload, selectinload
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 #Define model classes
 #Base classes are used for input validation. 
@@ -39,45 +46,103 @@ class Customer(CustomerBase, SQLModel, table=True):
 class Order(OrderBase, SQLModel, table=True):
     __tablename__ = "orders"
     id: int = Field(default=None, primary_key=True)
-    customer_id: int = Field(default = None, foreign_key="customers.id")
+    #Indexed because orders are looked up by customer, SQLite appends the id to every index entry so it also covers ORDER BY id
+    customer_id: int = Field(default = None, foreign_key="customers.id", index=True)
     customer: Customer = Relationship(back_populates="orders")
 
 #Read classes are used to include relationships in the response
 class CustomerRead(CustomerBase):
     orders: List[Order] = []
 
+#List classes hold only the columns a list view needs
+class CustomerList(BaseModel):
+    id: int
+    name: str
+    email: str
+
+class OrderList(BaseModel):
+    id: int
+    name: str
+    cost: Decimal
+    customer_id: int
+
+#Page classes wrap a list response with the key for the next page
+class CustomerPage(BaseModel):
+    items: List[CustomerList] = []
+    next: Optional[int] = None
+
 #Setup database in memory
-sqlite_url = f"sqlite://"
-engine = create_engine(sqlite_url, echo=True)
-SQLModel.metadata.create_all(engine)
+#aiosqlite keeps the event loop free while SQLite does its work
+#StaticPool reuses one long-lived connection, so the in-memory database and its page cache stay hot between requests
+sqlite_url = f"sqlite+aiosqlite:///:memory:"
+#SQL logging is off by default since it formats and writes every statement, set SQL_ECHO=1 to turn it on
+engine = create_async_engine(sqlite_url, echo=os.getenv("SQL_ECHO") == "1", echo_pool=False, pool_pre_ping=True, poolclass=StaticPool)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+#Dependency that hands each request a session from the pool
+async def get_db():
+    async with SessionLocal() as sesh:
+        yield sesh
+
+#Cached reads
+#Detail lookups keep their JSON body for a short while so repeat requests skip the query and serialization
+#Routes that change a customer or its orders invalidate the matching entries
+@alru_cache(maxsize=1024, ttl=30)
+async def cached_customer(id: int) -> Optional[bytes]:
+    async with SessionLocal() as sesh:
+        customer = await sesh.get(Customer, id)
+        if customer is None:
+            return None
+        return customer.model_dump_json().encode()
+
+@alru_cache(maxsize=1024, ttl=30)
+async def cached_customer_with_orders(id: int) -> Optional[bytes]:
+    async with SessionLocal() as sesh:
+        #Customer responses leave out relationships, so this is the only query that needs the orders loaded
+        #selectinload fetches them in one batched IN query instead of a lazy load per customer
+        #raiseload makes any other relationship access fail loudly instead of quietly adding queries
+        sql = select(Customer).where(Customer.id == id).options(selectinload(Customer.orders), raiseload("*"))
+        customer = (await sesh.execute(sql)).scalars().first()
+        if customer is None:
+            return None
+        return CustomerRead.model_validate(customer, from_attributes=True).model_dump_json().encode()
+
+#Answer with 304 Not Modified when the client already holds this exact body
+def etag_response(request: Request, body: bytes) -> Response:
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 #Sample data
-def seed_data():
+#Rows are inserted in bulk, one statement per table, instead of adding ORM objects one at a time
+async def seed_data():
     fake = Faker()
-    with Session(engine) as sesh:
-        for customer in (Customer(name = fake.name()
-                        ,address = fake.address()
-                        ,email = fake.ascii_safe_email())
-                        for i in range(10)):
-            sesh.add(customer)
-        sesh.commit()
-
-    with Session(engine) as sesh:
-        for customer in sesh.exec(select(Customer)).all():
-            for order in (Order(name = fake.text()
-                                ,cost = fake.pydecimal(2,2)
-                                ,customer_id = customer.id)
-                                for i in range(3)):
-                sesh.add(order)
-        sesh.commit()
-
-#Setup lifespan to seed data on startup and shutdown
+    async with SessionLocal() as sesh:
+        customers = [{"name": fake.name()
+                    ,"address": fake.address()
+                    ,"email": fake.ascii_safe_email()}
+                    for i in range(10)]
+        customer_ids = (await sesh.execute(insert(Customer).returning(Customer.id), customers)).scalars().all()
+
+        orders = [{"name": fake.text()
+                ,"cost": fake.pydecimal(2,2)
+                ,"customer_id": customer_id}
+                for customer_id in customer_ids
+                for i in range(3)]
+        await sesh.execute(insert(Order), orders)
+        await sesh.commit()
+
+#Setup lifespan to create tables and seed data on startup and shutdown
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     #startup
-    seed_data()
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    await seed_data()
     yield
     #shutdown
+    await engine.dispose()
     print("Shutting down")
 
 #Setup App
@@ -93,87 +158,108 @@ async def redirect_to_docs():
     return RedirectResponse(url='/docs', status_code=status.HTTP_307_TEMPORARY_REDIRECT)
 
 @app.get("/get-customers/", status_code = 200, tags=["customer"])
-async def get_customers(offset: int = None, limit: int = None) -> List[Customer]:
-    #Use offsets and limits to page through results
-    with Session(engine) as sesh:
-        offset = offset or 0
-        limit = limit or 0
-        if limit == 0:
-            sql = select(Customer).offset(offset)
-        else:
-            sql = select(Customer).offset(offset).limit(limit)
-        results = sesh.exec(sql).all()
-        return results
-
-@app.get("/get-customer-by-id/{id}", status_code = 200, tags=["customer"])
-async def get_customer_by_id(id: int) -> Customer:
-    with Session(engine) as sesh:
-        customer = sesh.get(Customer, id)
-        if customer is not None:
-            return customer
-        else:
-            raise HTTPException(status_code=404, detail = "Customer not found")
+async def get_customers(after_id: int = None, limit: int = 100, sesh: AsyncSession = Depends(get_db)) -> CustomerPage:
+    #Page through results by id, pass the returned "next" value as after_id to get the following page
+    #Seeking on the primary key avoids scanning and discarding every skipped row like OFFSET does
+    #Selecting plain columns skips building full ORM objects for every row
+    sql = select(Customer.id, Customer.name, Customer.email).order_by(Customer.id).limit(limit)
+    if after_id is not None:
+        sql = sql.where(Customer.id > after_id)
+    results = (await sesh.execute(sql)).mappings().all()
+    #Rows come straight from typed columns, so build the models without re-validating every field
+    items = [CustomerList.model_construct(**row) for row in results]
+    return CustomerPage.model_construct(items = items, next = items[-1].id if items else None)
+
+@app.get("/get-customer-by-id/{id}", status_code = 200, response_model=Customer, tags=["customer"])
+async def get_customer_by_id(id: int, request: Request):
+    body = await cached_customer(id)
+    if body is not None:
+        return etag_response(request, body)
+    else:
+        raise HTTPException(status_code=404, detail = "Customer not found")
 
 @app.post("/create-customer/", status_code = 201, tags=["customer"])
-async def create_customer(base: CustomerBase) -> Customer:
+async def create_customer(base: CustomerBase, sesh: AsyncSession = Depends(get_db)) -> Customer:
     new_customer = Customer(**base.model_dump())
-    with Session(engine) as sesh:
-        sesh.add(new_customer)
-        sesh.commit()
-        sesh.refresh(new_customer)
-        return new_customer
+    sesh.add(new_customer)
+    await sesh.commit()
+    await sesh.refresh(new_customer)
+    cached_customer.cache_invalidate(new_customer.id)
+    cached_customer_with_orders.cache_invalidate(new_customer.id)
+    return new_customer
 
 @app.put("/update-customer/", status_code = 200, tags=["customer"])
-async def update_customer(customer: Customer) -> Customer:
-    with Session(engine) as sesh:
-        sesh.merge(customer)
-        sesh.commit()
-        customer = sesh.get(Customer, customer.id)
-        return customer
-
-@app.get("/get-orders/", status_code = 200, tags=["order"])
-async def get_orders() -> List[Order]:
-    with Session(engine) as sesh:
-        sql = select(Order)
-        results = sesh.exec(sql).all()
-        return results
+async def update_customer(customer: Customer, sesh: AsyncSession = Depends(get_db)) -> Customer:
+    #A single UPDATE ... RETURNING replaces merge's SELECT followed by an UPDATE
+    sql = (update(Customer).where(Customer.id == customer.id)
+            .values(**customer.model_dump(exclude_unset=True, exclude={"id"}))
+            .returning(Customer))
+    customer = (await sesh.execute(sql)).scalars().first()
+    if customer is None:
+        raise HTTPException(status_code=404, detail = "Customer not found")
+    await sesh.commit()
+    cached_customer.cache_invalidate(customer.id)
+    cached_customer_with_orders.cache_invalidate(customer.id)
+    return customer
+
+@app.get("/get-orders/", status_code = 200, response_model=List[OrderList], tags=["order"])
+async def get_orders(sesh: AsyncSession = Depends(get_db)):
+    #Stream rows out as they are fetched instead of building the whole list in memory first
+    sql = select(Order.id, Order.name, Order.cost, Order.customer_id).execution_options(yield_per=500)
+    async def stream_orders():
+        yield b"["
+        first = True
+        async for row in (await sesh.stream(sql)).mappings():
+            yield (b"" if first else b",") + OrderList.model_construct(**row).model_dump_json().encode()
+            first = False
+        yield b"]"
+    return StreamingResponse(stream_orders(), media_type="application/json")
     
 @app.get("/get-order-by-id/", status_code = 200, tags=["order"])
-async def get_order_by_id(id: int) -> Order:
-    with Session(engine) as sesh:
-        order = sesh.get(Order, id)
-        if order is not None:
-            return order
-        else:
-            raise HTTPException(status_code=404, detail = "Order not found")
-        
+async def get_order_by_id(id: int, sesh: AsyncSession = Depends(get_db)) -> Order:
+    order = await sesh.get(Order, id)
+    if order is not None:
+        return order
+    else:
+        raise HTTPException(status_code=404, detail = "Order not found")
+    
 @app.post("/create-order/", status_code = 201, tags=["order"])
-async def create_order(base: OrderBase) -> Order:
+async def create_order(base: OrderBase, sesh: AsyncSession = Depends(get_db)) -> Order:
     new_order = Order(**base.model_dump())
-    with Session(engine) as sesh:
-        sesh.add(new_order)
-        sesh.commit()
-        sesh.refresh(new_order)
-        return new_order
+    sesh.add(new_order)
+    await sesh.commit()
+    await sesh.refresh(new_order)
+    cached_customer_with_orders.cache_invalidate(new_order.customer_id)
+    return new_order
     
 @app.put("/update-order/", status_code = 200, tags=["order"])
-async def update_order(order: Order) -> Order:
-    with Session(engine) as sesh:
-        sesh.merge(order)
-        sesh.commit()
-        order = sesh.get(Order, order.id)
-        return order
+async def update_order(order: Order, sesh: AsyncSession = Depends(get_db)) -> Order:
+    moves_customer = "customer_id" in order.model_fields_set
+    #A single UPDATE ... RETURNING replaces merge's SELECT followed by an UPDATE
+    sql = (update(Order).where(Order.id == order.id)
+            .values(**order.model_dump(exclude_unset=True, exclude={"id"}))
+            .returning(Order))
+    order = (await sesh.execute(sql)).scalars().first()
+    if order is None:
+        raise HTTPException(status_code=404, detail = "Order not found")
+    await sesh.commit()
+    #The previous owner isn't known once the row is updated, so drop every cached customer if it may have changed
+    if moves_customer:
+        cached_customer_with_orders.cache_clear()
+    else:
+        cached_customer_with_orders.cache_invalidate(order.customer_id)
+    return order
     
 @app.get("/get-orders-by-customer-id/", status_code = 200, response_model=List[Order], tags=["order"])
-async def get_customer_orders(id: int) -> List[Order]:
-    with Session(engine) as sesh:
-        sql = select(Order).where(Order.customer_id == id)
-        results = sesh.exec(sql).all()
-        return results
+async def get_customer_orders(id: int, sesh: AsyncSession = Depends(get_db)) -> List[Order]:
+    sql = select(Order).where(Order.customer_id == id).options(raiseload("*"))
+    results = (await sesh.execute(sql)).scalars().all()
+    return results
 
 @app.get("/get-customer-with-orders/{id}", status_code = 200, response_model=CustomerRead, tags=["customer"])
-async def get_customer_with_orders(id: int) -> CustomerRead:
-    with Session(engine) as sesh:
-        sql = select(Customer).where(Customer.id == id).options(selectinload(Customer.orders))
-        results = sesh.exec(sql).first()
-        return results
\ No newline at end of file
+async def get_customer_with_orders(id: int, request: Request):
+    body = await cached_customer_with_orders(id)
+    if body is not None:
+        return etag_response(request, body)
+    else:
+        raise HTTPException(status_code=404, detail = "Customer not found")
@@ -0,0 +1,31 @@
+#stdlib
+import asyncio
+import unittest
+
+#3rd party
+import httpx
+
+from app import app
+
+
+class ConcurrentWriteTest(unittest.IsolatedAsyncioTestCase):
+    #All sessions share one in-memory connection, so concurrent requests must not lose each other's writes
+    async def test_concurrent_creates_are_kept(self):
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                creates = [client.post("/create-customer/", json={"name": f"Customer {i}"}) for i in range(20)]
+                reads = [client.get("/get-customers/") for i in range(20)]
+                responses = await asyncio.gather(*creates, *reads)
+                self.assertEqual([r.status_code for r in responses[:20]], [201] * 20)
+                self.assertEqual([r.status_code for r in responses[20:]], [200] * 20)
+
+                created = {r.json()["id"] for r in responses[:20]}
+                self.assertEqual(len(created), 20)
+                for id in created:
+                    r = await client.get(f"/get-customer-by-id/{id}")
+                    self.assertEqual(r.status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()